@@ -1,42 +1,110 @@
+import asyncio
+import bisect
+import concurrent.futures
 import datetime
+import itertools
 import logging
 import json
+import os
 from pathlib import Path
-import urllib.request
+
+import aiohttp
 
 from parse_captions import parse
 
 
+API_URL = "https://reflect-ctn.cablecast.tv/cablecastapi/v1"
+
+# Maximum number of VODs whose show info / captions we'll fetch at
+# once; this is also the size of the HTTP connection pool
+MAX_CONCURRENT_FETCHES = 16
+
+# How many times to retry a request that fails to connect, and the
+# initial delay (in seconds) between retries
+FETCH_RETRIES = 3
+FETCH_RETRY_BACKOFF = 0.3
+
+
 def get_date_from_show(show):
-    # XXX fromisoformat does not like the full date-time here, so
-    # we'll just grab the date portion and cut off the time.
+    """Return the date of a show's original event, as a "YYYY-MM-DD" string."""
+    # The dates we get back are full ISO date-times, but we only want
+    # the date portion. We still check that each candidate is a real
+    # date (date.fromisoformat raises if not) before settling on it.
     try:
         # field #6 seems to be "Original Event Date"
         (date_field,) = [x for x in show["customFields"] if x["showField"] == 6]
-        return datetime.datetime.fromisoformat(date_field["value"].split("T")[0])
+        event_date = date_field["value"][:10]
+        datetime.date.fromisoformat(event_date)
+        return event_date
     except Exception as e:
         logging.warning("Original date for show {} not found: {}".format(show["id"], e))
         try:
-            # try to parse the date that's usually part of the show title
-            return datetime.datetime.strptime(show["title"][-6:], "%y%m%d")
+            # try the date that's usually part of the show title (as YYMMDD)
+            return datetime.datetime.strptime(show["title"][-6:], "%y%m%d").strftime(
+                "%Y-%m-%d"
+            )
         except Exception as e:
             # eventDate exists always, but is sometimes inaccurate
-            return datetime.datetime.fromisoformat(show["eventDate"].split("T")[0])
+            return show["eventDate"][:10]
 
 
-def retrieve_captions_for_vod(vod, workdir="raw_captions"):
-    show_info_url = "https://reflect-ctn.cablecast.tv/cablecastapi/v1/shows/{}".format(
-        vod["show"]
-    )
+async def fetch(session, url, as_json=False):
+    # Retry (with exponential backoff) if we can't reach the server at
+    # all; HTTP error responses (like a 404 for missing captions) are
+    # raised right away.
+    for attempt in range(FETCH_RETRIES + 1):
+        try:
+            async with session.get(url) as r:
+                r.raise_for_status()
+                if as_json:
+                    return await r.json()
+                return await r.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == FETCH_RETRIES:
+                raise
+            delay = FETCH_RETRY_BACKOFF * (2 ** attempt)
+            logging.info("Retrying {} in {}s: {}".format(url, delay, e))
+            await asyncio.sleep(delay)
+
+
+async def fetch_json(session, url):
+    return await fetch(session, url, as_json=True)
+
+
+async def get_show_info(session, show_id, shows_cache):
+    # Several VODs can belong to the same show (reruns, multi-part
+    # uploads), so we remember the few bits of show info we need
+    # rather than fetching it again. (JSON object keys are always
+    # strings, hence the str())
+    cached = shows_cache.get(str(show_id))
+    if cached is not None:
+        logging.debug("Using cached show info for show {}".format(show_id))
+        return cached
+
+    show_info_url = "{}/shows/{}".format(API_URL, show_id)
     logging.info("fetching show info: {}".format(show_info_url))
-    with urllib.request.urlopen(show_info_url) as r:
-        body = json.loads(r.read())
+    body = await fetch_json(session, show_info_url)
     show = body["show"]
 
+    show_info = {
+        "title": show["title"],
+        "id": show["id"],
+        "event_date": get_date_from_show(show),
+    }
+    shows_cache[str(show_id)] = show_info
+    return show_info
+
 
-    title = show["title"]
-    show_id = show["id"]
-    event_date = get_date_from_show(show)
+async def retrieve_captions_for_vod(
+    session, vod, workdir="raw_captions", shows_cache=None
+):
+    if shows_cache is None:
+        shows_cache = {}
+    show_info = await get_show_info(session, vod["show"], shows_cache)
+
+    title = show_info["title"]
+    show_id = show_info["id"]
+    event_date = show_info["event_date"]
 
     # the VOD URLs all end in "vod.mp4"; there is also a "vod.m3u8"
     # which sometimes references a "captions.m3u8" which points to a
@@ -52,52 +120,120 @@ def retrieve_captions_for_vod(vod, workdir="raw_captions"):
     try:
         p = Path(
             workdir,
-            "{}-{}-{}.vtt".format(event_date.strftime("%Y-%m-%d"), title, show_id),
+            "{}-{}-{}.vtt".format(event_date, title, show_id),
         )
-        filename, headers = urllib.request.urlretrieve(caption_url, filename=str(p))
-        p = Path(filename)
-        if p.stat().st_size < 100:
-            logging.info("Captions for {} were empty; deleting".format(title))
-            p.unlink()
+        captions = await fetch(session, caption_url)
+        if len(captions) < 100:
+            logging.info("Captions for {} were empty; skipping".format(title))
+            return
+
+        # Caption files are small, so hand the whole buffer off to a
+        # worker thread to write in one go rather than bouncing each
+        # chunk through the event loop.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, p.write_bytes, captions)
 
     except Exception as e:
-        logging.info("Could not download captions for {}: {}".format(show["title"], e))
+        logging.info("Could not download captions for {}: {}".format(title, e))
 
 
-def fetch_new_raw_captions(known_vods):
-    known_vods = set(known_vods)
+async def fetch_new_raw_captions(known_vods, shows_cache=None):
+    # "known_vods" is kept sorted (that's how it's stored in the state
+    # file), alongside a set for quick membership checks
+    known_vods = list(known_vods)
+    known_vod_set = set(known_vods)
 
     # XXX We could store the last page number visited and start from
     # there on subsequent script runs; however, because VOD IDs do not
     # appear in order, there appears to be no firm guarantee that new
     # ones would appear "at the end". So, for now we'll fetch the
     # entire set, every time
-    page = 0
     page_size = 100
 
-    while True:
-        vod_list_url = "https://reflect-ctn.cablecast.tv/cablecastapi/v1/vods?page_size={}&offset={}".format(
-            page_size, page
+    def vod_list_url(page):
+        return "{}/vods?page_size={}&offset={}".format(API_URL, page_size, page)
+
+    async def fetch_page(session, page):
+        url = vod_list_url(page)
+        logging.info("Fetching list of VODs: {}".format(url))
+        return await fetch_json(session, url)
+
+    sem = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+    async def retrieve(session, vods):
+        # All VODs of a show are saved to the same captions file, so
+        # we retrieve them one at a time, in the order the API gave
+        # them to us; as before, the last one wins.
+        for vod in vods:
+            async with sem:
+                try:
+                    await retrieve_captions_for_vod(
+                        session, vod, shows_cache=shows_cache
+                    )
+                except Exception as e:
+                    # Don't mark the VOD as known; we'll retry on the next run
+                    logging.warning(
+                        "Could not retrieve show info for vod {}: {}".format(
+                            vod["id"], e
+                        )
+                    )
+                    continue
+            bisect.insort(known_vods, vod["id"])
+            known_vod_set.add(vod["id"])
+
+    # All requests share one session, so connections (and their TLS
+    # handshakes) are kept alive and reused across requests
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_FETCHES)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        # The first page tells us how many VODs there are in total, so
+        # we can then go fetch all the remaining pages at once.
+        first = await fetch_page(session, 0)
+        n_pages = (first["meta"]["count"] // page_size) + 1
+        bodies = [first] + list(
+            await asyncio.gather(
+                *[fetch_page(session, page) for page in range(1, n_pages)]
+            )
         )
-        logging.info("Fetching list of VODs: {}".format(vod_list_url))
-        with urllib.request.urlopen(vod_list_url) as r:
-            body = json.loads(r.read())
 
-        for v in body["vods"]:
-            if v["id"] in known_vods:
-                logging.debug("Skipping previously-seen vod {}".format(v["id"]))
-                continue
-            retrieve_captions_for_vod(v)
-            known_vods.add(v["id"])
+        new_vods = {}
+        for body in bodies:
+            for v in body["vods"]:
+                if v["id"] in known_vod_set:
+                    logging.debug("Skipping previously-seen vod {}".format(v["id"]))
+                    continue
+                new_vods[v["id"]] = v
 
-        if ((page + 1) * page_size) > body["meta"]["count"]:
-            break
-        page += 1
+        vods_by_show = {}
+        for v in new_vods.values():
+            vods_by_show.setdefault(v["show"], []).append(v)
+
+        await asyncio.gather(
+            *[retrieve(session, vods) for vods in vods_by_show.values()]
+        )
 
     return known_vods
 
 
-def parse_new_captions(srcdir="raw_captions", dstdir="transcripts"):
+def parse_one_file(src_filepath, dest_filepath, known_speakers):
+    """Parse a single raw captions file into a transcript. This runs in a worker
+    process, so rather than raising, it returns a (src filename, success, error)
+    tuple for the caller to report."""
+    try:
+        with open(src_filepath, "r") as fp:
+            captions = parse(fp, no_infer_speakers=True, known_speakers=known_speakers)
+    except Exception as e:
+        return (src_filepath.name, False, e)
+
+    with open(dest_filepath, "w") as fp:
+        fp.write(captions.get_transcript())
+    return (src_filepath.name, True, None)
+
+
+def parse_new_captions(
+    srcdir="raw_captions", dstdir="transcripts", known_speakers=None
+):
+    src_filepaths = []
+    dest_filepaths = []
     for src_filepath in Path(srcdir).iterdir():
         src_filename = src_filepath.name
         if not src_filename.endswith(".vtt"):
@@ -110,15 +246,39 @@ def parse_new_captions(srcdir="raw_captions", dstdir="transcripts"):
             continue
 
         logging.info("Parsing {}".format(src_filename))
-        with open(src_filepath, "r") as fp:
-            try:
-                captions = parse(fp, no_infer_speakers=True)
-            except Exception as e:
-                logging.warning("Error parsing {}: {}".format(src_filepath, e))
-                continue
+        src_filepaths.append(src_filepath)
+        dest_filepaths.append(dest_filepath)
 
-        with open(dest_filepath, "w") as fp:
-            fp.write(captions.get_transcript())
+    # Each file is parsed independently (and parsing is CPU-bound), so
+    # spread them across all available cores
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = executor.map(
+            parse_one_file,
+            src_filepaths,
+            dest_filepaths,
+            itertools.repeat(known_speakers),
+            chunksize=4,
+        )
+        for src_filename, ok, e in results:
+            if not ok:
+                logging.warning("Error parsing {}: {}".format(src_filename, e))
+
+
+def load_json(path, default):
+    try:
+        with open(path, "r") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return default
+
+
+def save_json(data, path):
+    # Write to a temporary file and then move it into place, so we
+    # never leave a half-written file behind if we're killed
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(data, fp)
+    os.replace(tmp_path, path)
 
 
 def main():
@@ -131,20 +291,24 @@ def main():
     # re-download them each time this script runs. We need to do it
     # this way because the API, for some reason, does not return them
     # in increasing order
-    known_vods = set()
+    state = load_json("state.json", {"known_vods": []})
 
-    try:
-        with open("state.json", "r") as fp:
-            state = json.load(fp)
-    except FileNotFoundError:
-        state = {"known_vods": []}
+    # Show info (title and date) for every show we've previously seen
+    shows_cache = load_json("shows_cache.json", {})
 
-    known_vods = fetch_new_raw_captions(state["known_vods"])
-    parse_new_captions()
+    # Speaker inference is currently disabled when building the
+    # transcripts, but we'll load the list once here so the workers
+    # don't each need to read it.
+    with open("known_speakers.txt", "r") as fp:
+        known_speakers = [line.strip() for line in fp if line.strip()]
+
+    known_vods = asyncio.run(
+        fetch_new_raw_captions(state["known_vods"], shows_cache=shows_cache)
+    )
+    parse_new_captions(known_speakers=known_speakers)
 
-    with open("state.json", "w") as fp:
-        state = {"known_vods": sorted(known_vods)}
-        json.dump(state, fp)
+    save_json({"known_vods": known_vods}, "state.json")
+    save_json(shows_cache, "shows_cache.json")
 
 
 if __name__ == "__main__":
@@ -1,57 +1,145 @@
 import argparse
+import atexit
 import collections
 import csv
-import datetime
+import hashlib
 import json
+import os
 from io import StringIO
 import pprint
 import re
 import sys
 
-import jellyfish
+from rapidfuzz.distance import Levenshtein
 import webvtt
 
 Block = collections.namedtuple(
     "Block", ["start", "end", "duration", "speaker", "speech"]
 )
+Cue = collections.namedtuple("Cue", ["start", "end", "text"])
 
-PLACEHOLDER_DATE = datetime.date(1970, 1, 1)
 UNKNOWN_SPEAKER = "UNKNOWN"
+TIMESTAMP_LINE_PATTERN = re.compile(r"^\d\d\:\d\d\:\d\d\.\d\d\d", re.MULTILINE)
+CUE_TIMINGS_PATTERN = re.compile(
+    r"\s*((?:\d+:)?\d{2}:\d{2}.\d{3})\s*-->\s*((?:\d+:)?\d{2}:\d{2}.\d{3})"
+)
+CUE_TIMESTAMP_PATTERN = re.compile(r"(?:(\d+):)?(\d{2}):(\d{2}).(\d{3})")
+CUE_TEXT_TAGS_PATTERN = re.compile(r"<.*?>")
+CUE_COMMENT_PATTERN = re.compile(r"NOTE(?:\s.+|$)")
+CUE_STYLE_PATTERN = re.compile(r"STYLE[ \t]*$")
+
+
+def timestamp_to_ms(timestamp):
+    """Convert a WebVTT "HH:MM:SS.mmm" timestamp to integer milliseconds."""
+    return (
+        int(timestamp[0:2]) * 3600000
+        + int(timestamp[3:5]) * 60000
+        + int(timestamp[6:8]) * 1000
+        + int(timestamp[9:12])
+    )
 
 
 def calc_duration(start_time, end_time):
-    start_time = datetime.datetime.combine(
-        PLACEHOLDER_DATE, datetime.time.fromisoformat(start_time)
-    )
-    end_time = datetime.datetime.combine(
-        PLACEHOLDER_DATE, datetime.time.fromisoformat(end_time)
-    )
-    return (end_time - start_time).total_seconds()
+    # Called once per caption, so we avoid building datetime objects
+    # here. Doing the arithmetic in integer milliseconds also gives
+    # the exact same result as timedelta.total_seconds() would.
+    return (timestamp_to_ms(end_time) - timestamp_to_ms(start_time)) / 1000
 
 
 def get_closest_match(query, knowns):
     """For a string 'query', find which string in the 'knowns' list has the lowest
-    levenshtein edit distance."""
-    (lowest_score, best_candidate) = min(
-        (jellyfish.levenshtein_distance(query, candidate), candidate)
-        for candidate in knowns
+    levenshtein edit distance. Ties go to whichever candidate comes first in
+    'knowns'."""
+    # The edit distance between two strings is at least the difference
+    # in their lengths, so if we try the closest-length candidates
+    # first, we can stop as soon as the length difference alone rules
+    # out everything that's left. We also tell rapidfuzz to give up on
+    # any candidate once it can't beat the best score so far.
+    candidates = sorted(
+        (abs(len(query) - len(candidate)), idx, candidate)
+        for idx, candidate in enumerate(knowns)
     )
+    best = None
+    for length_diff, idx, candidate in candidates:
+        if best is not None and length_diff > best[0]:
+            break
+        score = Levenshtein.distance(
+            query, candidate, score_cutoff=None if best is None else best[0]
+        )
+        if best is None or (score, idx) < best[:2]:
+            best = (score, idx, candidate)
+
+    (lowest_score, idx, best_candidate) = best
     return best_candidate
 
 
-def get_speech_blocks(captions, no_infer_speakers, known_speakers):
+def get_speaker_list_version(known_speakers):
+    """Return a stable tag identifying the contents of the 'known_speakers' list,
+    so that cached typo corrections can be discarded when it changes."""
+    return hashlib.sha1("\n".join(sorted(known_speakers)).encode()).hexdigest()
+
+
+def load_speaker_cache(path, known_speakers):
+    """Load previously-inferred speaker typo corrections from 'path'. The returned
+    dict is written back to 'path' when the process exits, so any corrections
+    added to it are remembered for next time."""
+    version = get_speaker_list_version(known_speakers)
+    try:
+        with open(path, "r") as fp:
+            state = json.load(fp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        state = {}
+
+    if state.get("version") == version:
+        speaker_cache = state["speakers"]
+    else:
+        speaker_cache = {}
+    original_speaker_cache = dict(speaker_cache)
+
+    def save():
+        if speaker_cache == original_speaker_cache:
+            return
+        # Write to a temporary file and then move it into place, so we
+        # never leave a half-written cache behind if we're killed
+        tmp_path = str(path) + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(
+                {"version": version, "speakers": speaker_cache},
+                fp,
+                indent=4,
+                sort_keys=True,
+            )
+        os.replace(tmp_path, path)
+
+    atexit.register(save)
+    return speaker_cache
+
+
+def get_speech_blocks(captions, no_infer_speakers, known_speakers, speaker_cache=None):
     # Implemented as a closure rather than a standalone function so we
     # can cache results in "speaker_map". We'll only run the
     # levenshtein distance checks when we encounter a typo we haven't
-    # seen before!
+    # seen before! If we're given a "speaker_cache" (which persists
+    # across transcripts), we'll also check for typos we've seen in
+    # other transcripts before resorting to the levenshtein checks.
+    if speaker_cache is None:
+        speaker_cache = {}
     speaker_map = {s: s for s in known_speakers}
+    speaker_prefix_map = {}
     blocks = []
 
+    # Sorted so that ties in get_closest_match go to the alphabetically
+    # first candidate
+    known_speakers = sorted(known_speakers)
+
     def infer_speaker(speaker):
         if no_infer_speakers:
             return speaker
         if speaker not in speaker_map:
-            inferred_speaker = get_closest_match(speaker, known_speakers)
+            inferred_speaker = speaker_cache.get(speaker)
+            if inferred_speaker is None:
+                inferred_speaker = get_closest_match(speaker, known_speakers)
+                speaker_cache[speaker] = inferred_speaker
             speaker_map[speaker] = inferred_speaker
             return inferred_speaker
         else:
@@ -61,7 +149,7 @@ def get_speech_blocks(captions, no_infer_speakers, known_speakers):
     start_time = None
     end_time = None
     duration = 0
-    current_speech = ""
+    current_speech = []
     speaker = UNKNOWN_SPEAKER
     for idx, caption in enumerate(captions):
         # Apparently CTN's webvtt caption text are terminated in null bytes
@@ -88,9 +176,15 @@ def get_speech_blocks(captions, no_infer_speakers, known_speakers):
             # Record the previous speech "block" and start a new one
             if start_time is not None:
                 blocks.append(
-                    Block(start_time, end_time, duration, speaker, current_speech)
+                    Block(
+                        start_time,
+                        end_time,
+                        duration,
+                        speaker,
+                        " ".join(current_speech),
+                    )
                 )
-            current_speech = line
+            current_speech = [line]
             start_time = caption.start
             end_time = caption.end
             duration = 0
@@ -100,15 +194,21 @@ def get_speech_blocks(captions, no_infer_speakers, known_speakers):
             # speaker after a ">>". For everybody else, they don't
             # make any attempt to identify who's talking.
             if ":" in line:
-                # Typos are fairly common in speaker names, so we'll
-                # try to correct them
-                speaker = infer_speaker(line[2:].split(":")[0].strip().lower())
+                # The same few speaker prefixes show up over and over,
+                # so remember what each raw prefix resolved to
+                prefix = line[: line.index(":")]
+                speaker = speaker_prefix_map.get(prefix)
+                if speaker is None:
+                    # Typos are fairly common in speaker names, so we'll
+                    # try to correct them
+                    speaker = infer_speaker(prefix[2:].strip().lower())
+                    speaker_prefix_map[prefix] = speaker
             else:
                 speaker = UNKNOWN_SPEAKER
         else:
             # Append the line to the existing speech block, and extend
             # the end time to the end time of the latest caption
-            current_speech += " " + line
+            current_speech.append(line)
             end_time = caption.end
 
         # We're calculating the "duration" of a speech block as the
@@ -124,7 +224,9 @@ def get_speech_blocks(captions, no_infer_speakers, known_speakers):
 
     # Record the final "block"
     if start_time is not None:
-        blocks.append(Block(start_time, end_time, duration, speaker, current_speech))
+        blocks.append(
+            Block(start_time, end_time, duration, speaker, " ".join(current_speech))
+        )
     return blocks, speaker_map
 
 
@@ -133,24 +235,104 @@ def preprocess(webvtt_fp):
     VTT files, so here's a hack to just skip all the headers and return only the
     caption content itself, starting from the first timestamp'ed line."""
 
-    timestamp_pattern = re.compile(r"^\d\d\:\d\d\:\d\d\.\d\d\d")
-
-    # go line-by-line until we find a line starting with a timestamp
-    file_pos = 0
-    while True:
-        line = webvtt_fp.readline()
-        if not line:
-            # End-of-file!
-            raise Exception("No timestamp-like lines found!")
-        if timestamp_pattern.match(line):
-            break
-        file_pos = webvtt_fp.tell()
+    # read the whole file in one go and find the first line starting
+    # with a timestamp
+    content = webvtt_fp.read()
+    match = TIMESTAMP_LINE_PATTERN.search(content)
+    if match is None:
+        raise Exception("No timestamp-like lines found!")
+
+    # return everything from that line on, and prepend the magic
+    # "WEBVTT" header!
+    return "WEBVTT\r\n\r\n" + content[match.start() :]
+
+
+def normalize_cue_timestamp(timestamp):
+    """Return a cue timestamp in "HH:MM:SS.mmm" form (the hours are optional in
+    WebVTT), the same way the "webvtt" module reports them."""
+    hours, minutes, seconds, ms = CUE_TIMESTAMP_PATTERN.match(timestamp).groups()
+    return "{:02d}:{}:{}.{}".format(int(hours or 0), minutes, seconds, ms)
+
+
+def iter_cues(content):
+    """Yield a Cue for each caption in the WebVTT text 'content'.
+
+    The "webvtt" module builds the full list of captions up front, but we only
+    ever need to look at them one at a time, so this parses them one block at a
+    time instead. It follows the "webvtt" module's rules (including raising an
+    exception on malformed cues and misplaced style blocks, so the same files are
+    rejected), and strips cue tags from the text just like it does."""
+
+    def parse_cue_block(lines, line_number):
+        start = end = None
+        text_lines = []
+        following_lines = []
+        for idx, line in enumerate(lines):
+            if "-->" in line:
+                if start is not None:
+                    # Another timings line without a blank line in
+                    # between starts a new block
+                    following_lines = lines[idx:]
+                    break
+                match = CUE_TIMINGS_PATTERN.match(line)
+                if match is None:
+                    raise Exception(
+                        "Invalid time format in line {}".format(line_number + idx)
+                    )
+                start = normalize_cue_timestamp(match.group(1))
+                end = normalize_cue_timestamp(match.group(2))
+            elif idx > 0:
+                # (the first line, if it's not the timings, is the cue
+                # identifier, which we don't care about)
+                text_lines.append(line)
+
+        yield Cue(start, end, CUE_TEXT_TAGS_PATTERN.sub("", "\n".join(text_lines)))
+        if following_lines:
+            yield from parse_block(following_lines, line_number + idx)
+
+    def parse_block(lines, line_number):
+        nonlocal seen_cue
+        if any("-->" in line for line in lines[:2]):
+            seen_cue = True
+            yield from parse_cue_block(lines, line_number)
+        elif CUE_COMMENT_PATTERN.match(lines[0]):
+            return
+        elif CUE_STYLE_PATTERN.match(lines[0]):
+            if seen_cue:
+                raise Exception(
+                    "Style block defined after the first cue in line {}".format(
+                        line_number
+                    )
+                )
+        elif len(lines) == 1:
+            raise Exception("Standalone cue identifier in line {}".format(line_number))
+        else:
+            raise Exception("Missing timing cue in line {}".format(line_number + 1))
+
+    seen_cue = False
+
+    lines = []
+    first_line_number = None
+    is_signature = True
+    for line_number, line in enumerate(StringIO(content), start=1):
+        line = line.rstrip("\n\r")
+        if line:
+            if not lines and not line.strip():
+                continue
+            if not lines:
+                first_line_number = line_number
+            lines.append(line)
+            continue
 
-    # go back to the beginning of that line
-    webvtt_fp.seek(file_pos)
+        if lines:
+            if is_signature:
+                is_signature = False
+            else:
+                yield from parse_block(lines, first_line_number)
+            lines = []
 
-    # read the rest of the file, and prepend the magic "WEBVTT" header!
-    return "WEBVTT\r\n\r\n" + webvtt_fp.read()
+    if lines and not is_signature:
+        yield from parse_block(lines, first_line_number)
 
 
 class ParsedCaptions(object):
@@ -170,16 +352,27 @@ class ParsedCaptions(object):
         return speaker_times
 
 
-def parse(captions_fp, no_infer_speakers=True, known_speakers=None):
+def parse(
+    captions_fp,
+    no_infer_speakers=True,
+    known_speakers=None,
+    speaker_cache=None,
+    use_webvtt_module=False,
+):
     if known_speakers is None:
         known_speakers = []
     known_speakers = known_speakers + [UNKNOWN_SPEAKER]
 
     content = preprocess(captions_fp)
 
-    captions = webvtt.read_buffer(StringIO(content))
+    if use_webvtt_module:
+        captions = webvtt.read_buffer(StringIO(content))
+    else:
+        captions = iter_cues(content)
 
-    blocks, speaker_map = get_speech_blocks(captions, no_infer_speakers, known_speakers)
+    blocks, speaker_map = get_speech_blocks(
+        captions, no_infer_speakers, known_speakers, speaker_cache
+    )
 
     return ParsedCaptions(blocks, speaker_map)
 
@@ -216,6 +409,14 @@ def main():
             "against a fixed set of known speakers."
         ),
     )
+    parser.add_argument(
+        "--use-webvtt-module",
+        action="store_true",
+        help=(
+            'Parse captions with the "webvtt" module rather than our own '
+            "streaming parser."
+        ),
+    )
     parser.add_argument(
         "--speaker-list-file",
         help=(
@@ -224,6 +425,14 @@ def main():
         ),
         default="known_speakers.txt",
     )
+    parser.add_argument(
+        "--speaker-cache-file",
+        help=(
+            "JSON file in which to remember inferred speaker names across "
+            'runs. (default: "speaker_cache.json")'
+        ),
+        default="speaker_cache.json",
+    )
     parser.add_argument(
         "--output-format",
         choices=["json", "csv"],
@@ -235,8 +444,20 @@ def main():
     with open(args.speaker_list_file, "r") as known_speakers_fp:
         known_speakers = [line.strip() for line in known_speakers_fp if line.strip()]
 
+    speaker_cache = None
+    if not args.no_infer_speakers:
+        speaker_cache = load_speaker_cache(
+            args.speaker_cache_file, known_speakers + [UNKNOWN_SPEAKER]
+        )
+
     with open(args.captions_file, "r") as captions_fp:
-        captions = parse(captions_fp, args.no_infer_speakers, known_speakers)
+        captions = parse(
+            captions_fp,
+            args.no_infer_speakers,
+            known_speakers,
+            speaker_cache,
+            args.use_webvtt_module,
+        )
 
     if args.get_transcript:
         print(captions.get_transcript())